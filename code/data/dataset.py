@@ -1,9 +1,15 @@
 import os
+import sys
 import cv2
+import atexit
+import pickle
+import weakref
 import numpy as np
 import pandas as pd
 import tifffile as tiff
-from torch.utils.data import Dataset
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from torch.utils.data import Dataset, Sampler
 
 from params import DATA_PATH, DATA_PATH_EXTRA
 from utils.rle import enc2mask
@@ -64,6 +70,175 @@ def simple_load(img_path):
     return img
 
 
+class TiffTileReader:
+    """
+    Reads regions of a tiff image, and only decodes the tiff tiles that are accessed.
+    The image behaves like a [H x W x 3] array that can be sliced.
+    The file is opened lazily in each process, so that DataLoader workers do not share handles.
+    Requires zarr, which is only imported when a reader is created.
+    """
+    def __init__(self, img_path):
+        """
+        Constructor.
+
+        Args:
+            img_path (str): Path to the image.
+        """
+        self.img_path = img_path
+        self.tif = None
+        self.open()
+
+        shape = self.store.shape
+        self.dims = [i for i, s in enumerate(shape) if s > 1]
+        self.channel_first = shape[self.dims[0]] == 3
+
+        if self.channel_first:
+            self.shape = (shape[self.dims[1]], shape[self.dims[2]], 3)
+        else:
+            self.shape = (shape[self.dims[0]], shape[self.dims[1]], 3)
+
+    def open(self):
+        """
+        Opens the first level of the tiff as a zarr array.
+        """
+        import zarr
+
+        self.close()
+        self.tif = tiff.TiffFile(self.img_path)
+        self.store = zarr.open(self.tif.series[0].aszarr(level=0), mode="r")
+        self.pid = os.getpid()
+
+    def close(self):
+        """
+        Closes the tiff file, if it is opened.
+        """
+        if self.tif is not None:
+            self.tif.close()
+        self.tif, self.store = None, None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["tif"], state["store"], state["pid"] = None, None, None
+        return state
+
+    def __del__(self):
+        try:
+            self.close()
+        except AttributeError:
+            pass
+
+    def __getitem__(self, key):
+        if self.pid != os.getpid() or self.tif is None:
+            self.open()
+
+        rows, cols = key[0], key[1]
+        index = [0] * len(self.store.shape)
+        if self.channel_first:
+            index[self.dims[0]], index[self.dims[1]], index[self.dims[2]] = slice(None), rows, cols
+        else:
+            index[self.dims[0]], index[self.dims[1]], index[self.dims[2]] = rows, cols, slice(None)
+
+        region = self.store[tuple(index)]
+        if self.channel_first:
+            region = np.ascontiguousarray(region.transpose(1, 2, 0))
+        return region
+
+
+SHARED_IMAGES = weakref.WeakSet()
+
+
+@atexit.register
+def unlink_shared_images():
+    """
+    Frees the shared memory blocks still owned by this process at exit.
+    """
+    for image in list(SHARED_IMAGES):
+        try:
+            image.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class SharedImage:
+    """
+    Image stored in shared memory, so that DataLoader workers read the image decoded
+    by the main process instead of holding a copy each.
+    Only the name of the memory block is pickled, workers attach to it lazily.
+    The process that created the block unlinks it when the image is released or deleted.
+    """
+    def __init__(self, img):
+        """
+        Constructor.
+
+        Args:
+            img (np array [H x W x 3]): Image to share.
+        """
+        self.shape = img.shape
+        self.dtype = img.dtype
+
+        self.shm = SharedMemory(create=True, size=max(img.nbytes, 1))
+        self.name = self.shm.name
+        self.owner = True
+        SHARED_IMAGES.add(self)
+
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        self.array[:] = img
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["shm"], state["array"], state["owner"] = None, None, False
+        return state
+
+    def attach(self):
+        """
+        Attaches to the shared memory block, without registering it to the resource tracker.
+        Workers can have their own tracker, which would try to unlink the block at exit.
+        """
+        if sys.version_info >= (3, 13):
+            self.shm = SharedMemory(name=self.name, track=False)
+        else:
+            register = resource_tracker.register
+            resource_tracker.register = lambda *args, **kwargs: None
+            try:
+                self.shm = SharedMemory(name=self.name)
+            finally:
+                resource_tracker.register = register
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def __getitem__(self, key):
+        if self.array is None:
+            self.attach()
+        return self.array[key]
+
+    def close(self):
+        """
+        Detaches from the shared memory block.
+        """
+        self.array = None
+        if self.shm is not None:
+            try:
+                self.shm.close()
+            except BufferError:  # a tile still references the buffer
+                return
+            self.shm = None
+
+    def unlink(self):
+        """
+        Frees the shared memory block, if this process created it.
+        """
+        if self.owner:
+            self.owner = False
+            shm = self.shm if self.shm is not None else SharedMemory(name=self.name)
+            shm.unlink()
+
+    def __del__(self):
+        try:
+            self.close()
+            self.unlink()
+        except (FileNotFoundError, AttributeError):
+            pass
+
+
 class InferenceDataset(Dataset):
     """
     Dataset for inference.
@@ -76,6 +251,9 @@ class InferenceDataset(Dataset):
         tile_size=256,
         reduce_factor=4,
         transforms=None,
+        lazy=False,
+        shared=False,
+        image=None,
     ):
         """
         Constructor.
@@ -87,8 +265,21 @@ class InferenceDataset(Dataset):
             tile_size (int, optional): Tile size. Defaults to 256.
             reduce_factor (int, optional): Reduce factor. Defaults to 4.
             transforms (albu transforms or None, optional): Transforms. Defaults to None.
+            lazy (bool, optional): Whether to read tiles from the tiff on the fly instead of
+                loading the whole image. Defaults to False.
+            shared (bool, optional): Whether to put the loaded image in shared memory
+                for the DataLoader workers. Ignored if lazy. Defaults to False.
+            image (SharedImage or None, optional): Already loaded image, used instead of
+                reading original_img_path. Defaults to None.
         """
-        self.original_img = simple_load(original_img_path)
+        if image is not None:
+            self.original_img = image
+        elif lazy:
+            self.original_img = TiffTileReader(original_img_path)
+        elif shared:
+            self.original_img = SharedImage(simple_load(original_img_path))
+        else:
+            self.original_img = simple_load(original_img_path)
         self.orig_size = self.original_img.shape
 
         self.raw_tile_size = tile_size
@@ -106,6 +297,25 @@ class InferenceDataset(Dataset):
         else:
             self.mask = None
 
+    def __getstate__(self):
+        # workers only need tiles, positions are cheaper to recompute than to pickle
+        state = self.__dict__.copy()
+        state["mask"], state["positions"] = None, None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.positions = self.get_positions()
+
+    def release(self):
+        """
+        Frees the shared memory holding the image, or closes the tiff it is read from.
+        """
+        if isinstance(self.original_img, SharedImage):
+            self.original_img.unlink()
+        elif isinstance(self.original_img, TiffTileReader):
+            self.original_img.close()
+
     def __len__(self):
         return len(self.positions)
 
@@ -163,6 +373,119 @@ class InferenceDataset(Dataset):
         return img, pos
 
 
+class SwappableDataset(Dataset):
+    """
+    Dataset wrapping an InferenceDataset that can be swapped for another image.
+    This allows to reuse a DataLoader and its persistent workers across images.
+    Workers hold a copy of the dataset, so the sampler yields (spec, index) pairs
+    and workers rebuild the InferenceDataset from the spec when the image changes.
+    The spec is sent with each batch of indices and only holds the image path, the dataset
+    parameters and the shared memory handle of the image, transforms are sent once to workers.
+    Images that are not read lazily are always put in shared memory.
+    """
+    def __init__(self, transforms=None):
+        """
+        Constructor.
+
+        Args:
+            transforms (albu transforms or None, optional): Transforms. Defaults to None.
+        """
+        self.transforms = transforms
+        self.inner = None
+        self.spec = None
+        self.sampler = SwappableSampler(self)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["inner"], state["spec"] = None, None
+        return state
+
+    def swap(self, original_img_path, rle=None, **kwargs):
+        """
+        Swaps the image.
+
+        Args:
+            original_img_path (str): Path to the image.
+            rle (str or None, optional): rle encoding, only used in the main process.
+            **kwargs: Other InferenceDataset parameters, except transforms.
+
+        Returns:
+            InferenceDataset: Dataset of the new image.
+        """
+        if not kwargs.get("lazy", False):
+            kwargs["shared"] = True
+
+        version = 0 if self.spec is None else self.spec[0] + 1
+        self.inner = InferenceDataset(
+            original_img_path, rle=rle, transforms=self.transforms, **kwargs
+        )
+
+        image = self.inner.original_img
+        if not isinstance(image, SharedImage):  # lazy readers are reopened by the workers
+            image = None
+        spec = (version, original_img_path, kwargs, image)
+        try:  # an unpicklable spec would silently kill the DataLoader feeder thread
+            pickle.dumps(spec)
+        except Exception:
+            self.inner.release()
+            self.inner = None
+            raise
+
+        self.spec = spec
+        return self.inner
+
+    def release(self):
+        """
+        Frees the shared memory or the tiff handle of the current image.
+        """
+        if self.inner is not None:
+            self.inner.release()
+
+    @property
+    def tile_size(self):
+        return self.inner.tile_size
+
+    @property
+    def orig_size(self):
+        return self.inner.orig_size
+
+    def __len__(self):
+        return 0 if self.inner is None else len(self.inner)
+
+    def __getitem__(self, key):
+        spec, idx = key
+        if self.spec is None or self.spec[0] != spec[0]:
+            _, original_img_path, kwargs, image = spec
+            if self.inner is not None:
+                self.inner.release()
+            self.inner = InferenceDataset(
+                original_img_path, transforms=self.transforms, image=image, **kwargs
+            )
+            self.spec = spec
+        return self.inner[idx]
+
+
+class SwappableSampler(Sampler):
+    """
+    Sequential sampler for SwappableDataset, indices are tagged with the current image spec.
+    """
+    def __init__(self, dataset):
+        """
+        Constructor.
+
+        Args:
+            dataset (SwappableDataset): Dataset to sample from.
+        """
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        spec = self.dataset.spec
+        return iter([(spec, idx) for idx in range(len(self.dataset))])
+
+
 class InMemoryTrainDataset(Dataset):
     """
     In Memory Dataset, which allows to smart tile sampling of any size and reduction factor.
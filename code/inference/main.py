@@ -1,24 +1,219 @@
+import os
 import torch
+import asyncio
 import numpy as np
 import pandas as pd
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 from training.predict import (
     predict_entire_mask_downscaled,
     predict_entire_mask,
     threshold_resize_torch,
-    predict_entire_mask_downscaled_tta
+    predict_entire_mask_downscaled_tta,
+    build_swappable_loader,
 )
 
 from model_zoo.models import define_model
 
-from data.dataset import InferenceDataset
 from data.transforms import HE_preprocess_test
 
-from utils.rle import enc2mask
-from utils.torch import load_model_weights
-from utils.metrics import dice_scores_img, tweak_threshold
+from utils.rle import enc2mask, runs2mask
+from utils.torch import (
+    load_model_weights,
+    compile_model,
+    warmup_model,
+    save_as_jit,
+    load_jit_model,
+    enable_inference_backends,
+    enable_expandable_segments,
+    CudaGraphModel,
+)
+from utils.metrics import tweak_threshold
+
+from params import TIFF_PATH, DATA_PATH, NUM_WORKERS_INFERENCE
+
+CONCURRENT_IMAGES = 2
+IO_POOL = ThreadPoolExecutor(max_workers=2)
+
 
-from params import TIFF_PATH, DATA_PATH
+def run_async(coroutine):
+    """
+    Runs a coroutine until completion.
+    When an event loop is already running (e.g. in notebooks), a new one is used in a thread.
+
+    Args:
+        coroutine (coroutine): Coroutine to run.
+
+    Returns:
+        Any: Result of the coroutine.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+class HostStagingBuffer:
+    """
+    Pinned host buffer reused to copy the predictions of successive images to the cpu.
+    Page-locked memory is kept by the caching host allocator, so allocating a buffer per image
+    would lock several GB of RAM. The buffer only grows, and only holds one pending save.
+    """
+    def __init__(self):
+        """
+        Constructor.
+        """
+        self.buffer = None
+        self.pending = None
+
+    def wait(self):
+        """
+        Waits for the pending save of the buffer to finish.
+        """
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def copy(self, tensor):
+        """
+        Asynchronously copies a tensor to the buffer, on the current stream.
+        The stream needs to be synchronized before reading the copy.
+
+        Args:
+            tensor (torch tensor): Tensor to copy, on the GPU.
+
+        Returns:
+            torch tensor: Pinned cpu tensor, view of the buffer.
+        """
+        self.wait()
+
+        nbytes = tensor.numel() * tensor.element_size()
+        if self.buffer is None or self.buffer.numel() < nbytes:
+            self.buffer = None
+            self.buffer = torch.empty(nbytes, dtype=torch.uint8, pin_memory=True)
+
+        pinned = self.buffer[:nbytes].view(tensor.dtype).view(tensor.shape)
+        pinned.copy_(tensor, non_blocking=True)
+        return pinned
+
+    def save(self, path, pinned):
+        """
+        Saves a copy of the buffer to a .npy file in the IO threads.
+
+        Args:
+            path (str): Path to save to.
+            pinned (torch tensor): Copy returned by self.copy.
+
+        Returns:
+            Future: Pending save.
+        """
+        self.pending = IO_POOL.submit(np.save, path, pinned.numpy())
+        return self.pending
+
+
+def load_mask_truth(img, rle, shape, cache_dir=None, runs=None):
+    """
+    Decodes the ground truth of an image.
+    When a cache folder is given, masks are decoded once and saved as .npy,
+    later calls memory-map the saved mask instead of decoding the rle.
+
+    Args:
+        img (str): Image name.
+        rle (str): Full resolution rle.
+        shape (tuple [2]): Mask size.
+        cache_dir (str or None, optional): Folder to cache masks to. Defaults to None.
+        runs (tuple of np arrays or None, optional): Precomputed (starts, lengths) of the rle,
+            used instead of parsing it. Defaults to None.
+
+    Returns:
+        np array [shape[1] x shape[0]]: Mask.
+    """
+    def decode():
+        if runs is not None:
+            return runs2mask(*runs, shape)
+        return enc2mask([rle], shape)
+
+    if cache_dir is None:
+        return decode()
+
+    path = os.path.join(cache_dir, f"{img}_mask.npy")
+    if os.path.exists(path):
+        return np.load(path, mmap_mode="c")
+
+    mask = decode()
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(path, mask)
+    return mask
+
+
+def score_pred(
+    pred, mask_truth, shape, threshold, resize=False, stream=None, chunk_size=4096, eps=1e-8
+):
+    """
+    Thresholds and scores a prediction on the GPU, on the stream it was computed on.
+    This avoids bringing the full resolution prediction back to the cpu.
+    The ground truth is uploaded and compared by chunks of rows, as booleans,
+    to keep the full resolution temporaries to the thresholded prediction only.
+
+    Args:
+        pred (torch tensor [H x W]): Prediction.
+        mask_truth (np array [H x W]): Ground truth.
+        shape (tuple [2]): Shape of the original image.
+        threshold (float): Threshold for probabilities.
+        resize (bool, optional): Whether to resize the prediction to shape. Defaults to False.
+        stream (torch Stream or None, optional): Stream to use. Defaults to None.
+        chunk_size (int, optional): Number of rows per chunk. Defaults to 4096.
+        eps (float, optional): epsilon to avoid dividing by 0. Defaults to 1e-8.
+
+    Returns:
+        float: Dice score.
+    """
+    with torch.cuda.stream(stream), torch.inference_mode():
+        if resize:
+            pred = threshold_resize_torch(pred, shape, threshold=threshold, to_numpy=False)
+        else:
+            pred = pred > threshold
+
+        intersect, union = 0, 0
+        for start in range(0, pred.size(0), chunk_size):
+            p = pred[start: start + chunk_size]
+            t = np.ascontiguousarray(mask_truth[start: start + chunk_size], dtype=bool)
+            t = torch.from_numpy(t).to(pred.device)
+
+            intersect += torch.logical_and(p, t).sum()
+            union += p.sum() + t.sum()
+
+        return float((2.0 * intersect + eps) / (union + eps))
+
+
+def read_validation_csvs(config, use_full_size=True):
+    """
+    Reads the image information and the rles used for validation.
+
+    Args:
+        config (Config): Parameters.
+        use_full_size (bool, optional): Whether to use full resolution images. Defaults to True.
+
+    Returns:
+        pandas dataframe: Image information.
+        pandas dataframe: Rles at the used resolution.
+        pandas dataframe: Full resolution rles.
+    """
+    df_info = pd.read_csv(DATA_PATH + "HuBMAP-20-dataset_information.csv")
+
+    if use_full_size:
+        rle_path = DATA_PATH + "train.csv"
+    else:
+        rle_path = DATA_PATH + f"train_{config.reduce_factor}.csv"
+
+    rles = pd.read_csv(rle_path)
+    rles_full = pd.read_csv(DATA_PATH + "train.csv")
+
+    return df_info, rles, rles_full
 
 
 def validate_inf(
@@ -31,6 +226,10 @@ def validate_inf(
     use_tta=False,
     save=False,
     save_all_tta=False,
+    df_info=None,
+    rles=None,
+    rles_full=None,
+    rle_cache=None,
 ):
     """
     Performs inference with a model on a list of train images.
@@ -46,98 +245,285 @@ def validate_inf(
         use_tta (bool, optional): Whether to use tta. Defaults to False.
         save (bool, optional): Whether to save predictions. Defaults to False.
         save_all_tta (bool, optional): Whether to save predictions for all tta. Defaults to False.
+        df_info (pandas dataframe or None, optional): Image information. Defaults to None.
+        rles (pandas dataframe or None, optional): Rles at the used resolution. Defaults to None.
+        rles_full (pandas dataframe or None, optional): Full resolution rles. Defaults to None.
+        rle_cache (NpzFile or None, optional): Full resolution rles parsed as runs,
+            see scripts/precompute_rle.py. Defaults to None.
     """
-    df_info = pd.read_csv(DATA_PATH + "HuBMAP-20-dataset_information.csv")
+    if df_info is None or rles is None or rles_full is None:
+        df_info, rles, rles_full = read_validation_csvs(config, use_full_size=use_full_size)
 
     if use_full_size:
         root = TIFF_PATH
-        rle_path = DATA_PATH + "train.csv"
         reduce_factor = config.reduce_factor
     else:
         root = DATA_PATH + f"train_{config.reduce_factor}/"
-        rle_path = DATA_PATH + f"train_{config.reduce_factor}.csv"
         reduce_factor = 1
 
-    rles = pd.read_csv(rle_path)
-    rles_full = pd.read_csv(DATA_PATH + "train.csv")
+    rle_by_id = dict(zip(rles.id, rles.encoding))
+    rle_full_by_id = dict(zip(rles_full.id, rles_full.encoding))
+    shape_by_id = {
+        os.path.splitext(name)[0]: (int(w), int(h))
+        for name, w, h in zip(df_info.image_file, df_info.width_pixels, df_info.height_pixels)
+    }
 
     print("\n    -> Validating \n")
-    scores = []
 
-    for img in val_images:
+    if isinstance(model, torch.nn.Module):
+        model = model.to(memory_format=torch.channels_last)
 
-        predict_dataset = InferenceDataset(
-            f"{root}/{img}.tiff",
-            rle=rles[rles["id"] == img]["encoding"],
-            overlap_factor=config.overlap_factor,
-            reduce_factor=reduce_factor,
-            tile_size=config.tile_size,
-            transforms=HE_preprocess_test(augment=False, visualize=False),
+    with torch.inference_mode(), torch.cuda.amp.autocast(dtype=torch.float16):
+        warmup_model(
+            model,
+            (config.val_bs, 3, config.tile_size, config.tile_size),
+            device=config.device,
+            memory_format=torch.channels_last,
         )
 
-        if save_all_tta:
-            global_pred = predict_entire_mask_downscaled_tta(
-                predict_dataset, model, batch_size=config.val_bs
+    save_futures = []
+
+    async def score_one(img, semaphore, slots):
+        """
+        Predicts and scores an image.
+        The prediction is dispatched on a CUDA stream of the pool, using the DataLoader
+        paired with it, while the cpu work is done in threads to let the other images run.
+
+        Args:
+            img (str): Image name.
+            semaphore (asyncio Semaphore): Bounds the number of images processed at once.
+            slots (asyncio Queue): Pool of (CUDA stream, DataLoader, HostStagingBuffer).
+
+        Returns:
+            float: Dice score.
+        """
+        loop = asyncio.get_running_loop()
+
+        async with semaphore:
+            shape = shape_by_id[img]
+            rle, runs = rle_full_by_id.get(img, np.nan), None
+            if rle_cache is not None and f"{img}_starts" in rle_cache:
+                rle, runs = None, (rle_cache[f"{img}_starts"], rle_cache[f"{img}_lengths"])
+
+            mask_future = loop.run_in_executor(
+                None,
+                load_mask_truth,
+                img,
+                rle,
+                shape,
+                getattr(config, "mask_cache_dir", None),
+                runs,
             )
-            np.save(
-                log_folder + f"pred_{img}.npy",
-                global_pred.cpu().numpy()
-            )
-
-            global_pred = global_pred.mean(0)
-
-        else:
-            if use_full_size:
-                global_pred = predict_entire_mask(
-                    predict_dataset, model, batch_size=config.val_bs, tta=use_tta
-                )
-                threshold, score = 0.4, 0
 
-            else:
-                global_pred = predict_entire_mask_downscaled(
-                    predict_dataset, model, batch_size=config.val_bs, tta=use_tta
+            stream, loader, staging = await slots.get()
+            try:
+                if save or save_all_tta:
+                    await loop.run_in_executor(None, staging.wait)
+
+                predict_dataset = await loop.run_in_executor(
+                    None,
+                    partial(
+                        loader.dataset.swap,
+                        f"{root}/{img}.tiff",
+                        # the dataset mask is only used to tweak the downscaled threshold
+                        rle=None if use_full_size else [rle_by_id.get(img, np.nan)],
+                        overlap_factor=config.overlap_factor,
+                        reduce_factor=reduce_factor,
+                        tile_size=config.tile_size,
+                        lazy=use_full_size,
+                        shared=not use_full_size,
+                    ),
                 )
 
-                threshold, score = tweak_threshold(
-                    mask=torch.from_numpy(predict_dataset.mask).cuda(), pred=global_pred
-                )
-                print(
-                    f" - Scored {score :.4f} for downscaled"
-                    f"image {img} with threshold {threshold:.2f}"
+                with torch.cuda.stream(stream), torch.inference_mode(), \
+                        torch.cuda.amp.autocast(dtype=torch.float16):
+                    if save_all_tta:
+                        global_pred_tta = predict_entire_mask_downscaled_tta(
+                            loader,
+                            model,
+                            batch_size=config.val_bs,
+                            num_classes=config.num_classes,
+                        )
+                        global_pred = global_pred_tta.mean(0)
+                        pinned_pred = staging.copy(global_pred_tta)
+                        del global_pred_tta
+
+                    else:
+                        if use_full_size:
+                            global_pred = predict_entire_mask(
+                                loader,
+                                model,
+                                batch_size=config.val_bs,
+                                tta=use_tta,
+                                num_classes=config.num_classes,
+                            )
+                            threshold, score = 0.4, 0
+
+                        else:
+                            global_pred = predict_entire_mask_downscaled(
+                                loader,
+                                model,
+                                batch_size=config.val_bs,
+                                tta=use_tta,
+                                num_classes=config.num_classes,
+                            )
+
+                            threshold, score = tweak_threshold(
+                                mask=torch.from_numpy(predict_dataset.mask).cuda(),
+                                pred=global_pred,
+                            )
+                            print(
+                                f" - Scored {score :.4f} for downscaled"
+                                f"image {img} with threshold {threshold:.2f}"
+                            )
+
+                        if save:
+                            pinned_pred = staging.copy(global_pred)
+
+                await loop.run_in_executor(None, stream.synchronize)
+                predict_dataset.release()
+
+                if save or save_all_tta:
+                    save_futures.append(staging.save(log_folder + f"pred_{img}.npy", pinned_pred))
+                    del pinned_pred
+
+                mask_truth = await mask_future
+
+                img_threshold = global_threshold if global_threshold is not None else threshold
+
+                score = await loop.run_in_executor(
+                    None,
+                    score_pred,
+                    global_pred,
+                    mask_truth,
+                    shape,
+                    img_threshold,
+                    not use_full_size,
+                    stream,
                 )
+                del global_pred, mask_truth, predict_dataset
+            finally:
+                loader.dataset.release()  # frees the shared image even if scoring failed
+                slots.put_nowait((stream, loader, staging))
 
-        shape = df_info[df_info.image_file == img + ".tiff"][
-            ["width_pixels", "height_pixels"]
-        ].values.astype(int)[0]
-        mask_truth = enc2mask(rles_full[rles_full["id"] == img]["encoding"], shape)
-
-        global_threshold = (
-            global_threshold if global_threshold is not None else threshold
+        print(
+            f" - Scored {score :.4f} for image {img} with threshold {img_threshold:.2f}\n"
         )
-
-        if save and not save_all_tta:
-            np.save(
-                log_folder + f"pred_{img}.npy",
-                global_pred.cpu().numpy()
+        return score
+
+    async def score_all():
+        semaphore = asyncio.Semaphore(CONCURRENT_IMAGES)
+        slots = asyncio.Queue()
+        loaders = []
+        for _ in range(CONCURRENT_IMAGES):
+            loader = build_swappable_loader(
+                batch_size=config.val_bs,
+                num_workers=NUM_WORKERS_INFERENCE // CONCURRENT_IMAGES,
+                transforms=HE_preprocess_test(augment=False, visualize=False),
             )
+            loaders.append(loader)
+            slots.put_nowait((torch.cuda.Stream(), loader, HostStagingBuffer()))
 
-        if not use_full_size:
-            global_pred = threshold_resize_torch(
-                global_pred, shape, threshold=global_threshold
+        try:
+            return list(
+                await asyncio.gather(*[score_one(img, semaphore, slots) for img in val_images])
             )
-        else:
-            global_pred = (global_pred > global_threshold).cpu().numpy()
+        finally:
+            for loader in loaders:
+                loader.dataset.release()
 
-        score = dice_scores_img(global_pred, mask_truth)
-        scores.append(score)
+    scores = run_async(score_all())
+    torch.cuda.empty_cache()
 
-        print(
-            f" - Scored {score :.4f} for image {img} with threshold {global_threshold:.2f}\n"
-        )
+    for future in save_futures:
+        future.result()
 
     return scores
 
 
+def is_up_to_date(path, weights_path):
+    """
+    Checks whether a file exported from weights exists and is not older than the weights.
+
+    Args:
+        path (str): Path to the exported file.
+        weights_path (str): Path to the weights it was exported from.
+
+    Returns:
+        bool: Whether the file can be reused.
+    """
+    if not os.path.exists(path):
+        return False
+    if not os.path.exists(weights_path):
+        return True
+    return os.path.getmtime(path) >= os.path.getmtime(weights_path)
+
+
+def load_inference_model(config, log_folder, fold):
+    """
+    Loads the model of a fold for inference.
+    The frozen TorchScript version of the model is used if it exists, otherwise the weights
+    are loaded in an eager model, which is traced for the next runs.
+    EfficientNets are not traceable, and compiled models are kept eager.
+    If config.use_trt is set, a TensorRT engine is built from the weights instead,
+    and reused for the next runs with the same tile and batch sizes.
+    Exported models older than the weights are rebuilt.
+
+    Args:
+        config (Config): Parameters.
+        log_folder (str): Folder to load the weights from.
+        fold (int): Fold index.
+
+    Returns:
+        torch model, ScriptModule or TrtModel: Model in eval mode.
+    """
+    name = f"{config.decoder}_{config.encoder}_{fold}"
+    use_trt = getattr(config, "use_trt", False)
+    use_compile = getattr(config, "compile", False) and not use_trt
+    use_jit = "efficientnet" not in config.encoder and not use_compile and not use_trt
+
+    weights_path = log_folder + f"{name}.pt"
+    engine_path = log_folder + f"{name}_{config.tile_size}_{config.val_bs}.engine"
+
+    if use_trt:  # TensorRT is an optional dependency
+        from utils.trt import TrtModel, export_onnx, build_engine
+
+        if is_up_to_date(engine_path, weights_path):
+            return TrtModel(engine_path)
+
+    if use_jit and is_up_to_date(log_folder + f"{name}_jit.pt", weights_path):
+        return load_jit_model(log_folder + f"{name}_jit.pt", device=config.device)
+
+    model = define_model(
+        config.decoder,
+        config.encoder,
+        num_classes=config.num_classes,
+        encoder_weights=config.encoder_weights,
+    ).to(config.device)
+    model.zero_grad()
+    model.eval()
+
+    load_model_weights(model, weights_path)
+
+    if use_trt:
+        export_onnx(model, log_folder + f"{name}.onnx", tile_size=config.tile_size)
+        build_engine(
+            log_folder + f"{name}.onnx",
+            engine_path,
+            tile_size=config.tile_size,
+            batch_size=config.val_bs,
+        )
+        return TrtModel(engine_path)
+
+    if use_jit:
+        save_as_jit(model, log_folder + f"{name}_jit.pt", tile_size=config.tile_size)
+
+    if use_compile:
+        model = compile_model(model)
+
+    return model
+
+
 def k_fold_inf(
     config,
     df,
@@ -150,6 +536,8 @@ def k_fold_inf(
 ):
     """
     Performs a k-fold inference on the train data.
+    If config.use_cuda_graph is set, the forward of eager and TorchScript models is replayed
+    from a CUDA graph.
 
     Args:
         config (Config): Parameters.
@@ -160,9 +548,23 @@ def k_fold_inf(
         use_tta (bool, optional): Whether to use tta. Defaults to False.
         save_all_tta (bool, optional): Whether to save predictions for all tta. Defaults to False.
     """
+    enable_inference_backends()
+    enable_expandable_segments()
+
+    # compiled models already use CUDA graphs in reduce-overhead mode
+    use_cuda_graph = getattr(config, "use_cuda_graph", False) and not (
+        getattr(config, "compile", False) or getattr(config, "use_trt", False)
+    )
+
     folds = df[config.cv_column].unique()
     scores = []
 
+    df_info, rles, rles_full = read_validation_csvs(config, use_full_size=use_full_size)
+
+    rle_cache = None
+    if os.path.exists(DATA_PATH + "rle_cache.npz"):
+        rle_cache = np.load(DATA_PATH + "rle_cache.npz")
+
     for i, fold in enumerate(folds):
         if i in config.selected_folds:
             print(f"\n-------------   Fold {i + 1} / {len(folds)}  -------------\n")
@@ -170,18 +572,14 @@ def k_fold_inf(
 
             val_images = df_val["tile_name"].apply(lambda x: x.split("_")[0]).unique()
 
-            model = define_model(
-                config.decoder,
-                config.encoder,
-                num_classes=config.num_classes,
-                encoder_weights=config.encoder_weights,
-            ).to(config.device)
-            model.zero_grad()
-            model.eval()
-
-            load_model_weights(
-                model, log_folder + f"{config.decoder}_{config.encoder}_{i}.pt"
-            )
+            model = load_inference_model(config, log_folder, i)
+
+            if use_cuda_graph:
+                model = CudaGraphModel(
+                    model.to(memory_format=torch.channels_last),
+                    (config.val_bs, 3, config.tile_size, config.tile_size),
+                    device=config.device,
+                )
 
             scores += validate_inf(
                 model,
@@ -193,6 +591,10 @@ def k_fold_inf(
                 use_tta=use_tta,
                 save=save,
                 save_all_tta=save_all_tta,
+                df_info=df_info,
+                rles=rles,
+                rles_full=rles_full,
+                rle_cache=rle_cache,
             )
 
     return scores
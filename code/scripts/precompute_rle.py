@@ -0,0 +1,19 @@
+"""
+Parses the training rles once and caches them as runs, to skip the parsing at inference.
+To run from the code folder :
+    python -m scripts.precompute_rle
+"""
+import argparse
+
+from params import DATA_PATH
+from utils.rle import precompute_rle_cache
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute parsed rles.")
+    parser.add_argument("--csv", default=DATA_PATH + "train.csv", help="Rles to parse.")
+    parser.add_argument("--out", default=DATA_PATH + "rle_cache.npz", help="Cache to write.")
+    args = parser.parse_args()
+
+    precompute_rle_cache(args.csv, args.out)
+    print(f"Saved parsed rles of {args.csv} to {args.out}")
@@ -1,8 +1,11 @@
 import gc
+import os
+import copy
 import time
 import torch
 import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 
 
 from params import DATA_PATH
@@ -12,7 +15,60 @@ from data.transforms import HE_preprocess
 from utils.metrics import tweak_threshold
 from training.predict import predict_entire_mask_downscaled
 from data.dataset import InMemoryTrainDataset, InferenceDataset
-from utils.torch import seed_everything, count_parameters, save_model_weights
+from utils.torch import (
+    seed_everything,
+    count_parameters,
+    save_model_weights,
+    compile_model,
+    warmup_model,
+    enable_inference_backends,
+    save_as_jit,
+)
+
+
+JIT_POOL = ThreadPoolExecutor(max_workers=1)
+JIT_FUTURES = []
+
+
+def submit_save_as_jit(model, config, fold, log_folder):
+    """
+    Traces and saves a cpu copy of a model in the background, to not delay the next fold.
+    EfficientNets are not traceable and are skipped.
+    A previously traced model is removed first, so that it is never used with newer weights.
+
+    Args:
+        model (torch model): Trained model.
+        config (Config): Parameters.
+        fold (int): Fold index.
+        log_folder (str): Folder to save the traced model to.
+    """
+    if "efficientnet" in config.encoder:
+        return
+
+    name = f"{config.decoder}_{config.encoder}_{fold}_jit.pt"
+    if os.path.exists(os.path.join(log_folder, name)):
+        os.remove(os.path.join(log_folder, name))
+
+    JIT_FUTURES.append(
+        JIT_POOL.submit(
+            save_as_jit,
+            copy.deepcopy(model).cpu(),
+            name,
+            tile_size=config.tile_size,
+            cp_folder=log_folder,
+        )
+    )
+
+
+def wait_save_as_jit():
+    """
+    Waits for the pending traced models to be saved, and raises if one of them failed.
+    """
+    try:
+        for future in JIT_FUTURES:
+            future.result()
+    finally:
+        JIT_FUTURES.clear()
 
 
 def train(config, dataset, fold, log_folder=None):
@@ -49,8 +105,11 @@ def train(config, dataset, fold, log_folder=None):
     dataset.update_fold_nb(fold)
     print("    -> Validation images :", dataset.valid_set, "\n")
 
+    # weights are saved from the eager model, compiled modules prefix their state dict keys
+    fit_model = compile_model(model) if getattr(config, "compile", False) else model
+
     meter, history = fit(
-        model,
+        fit_model,
         dataset,
         optimizer_name=config.optimizer,
         loss_name=config.loss,
@@ -66,6 +125,8 @@ def train(config, dataset, fold, log_folder=None):
         first_epoch_eval=config.first_epoch_eval,
         device=config.device,
         num_classes=config.num_classes,
+        ema_decay=getattr(config, "ema_decay", 0),
+        ema_first_epoch=getattr(config, "ema_first_epoch", 0),
     )
 
     if config.save_weights and log_folder is not None:
@@ -75,8 +136,9 @@ def train(config, dataset, fold, log_folder=None):
             name,
             cp_folder=log_folder,
         )
+        submit_save_as_jit(model, config, fold, log_folder)
 
-    return meter, history, model
+    return meter, history, fit_model
 
 
 def validate(model, config, val_images):
@@ -91,6 +153,17 @@ def validate(model, config, val_images):
     """
     rles = pd.read_csv(DATA_PATH + f"train_{config.reduce_factor}.csv")
     scores = []
+
+    model = model.to(memory_format=torch.channels_last)
+
+    with torch.inference_mode(), torch.cuda.amp.autocast(dtype=torch.float16):
+        warmup_model(
+            model,
+            (config.val_bs, 3, config.tile_size, config.tile_size),
+            device=config.device,
+            memory_format=torch.channels_last,
+        )
+
     for img in val_images:
 
         predict_dataset = InferenceDataset(
@@ -102,13 +175,14 @@ def validate(model, config, val_images):
             transforms=HE_preprocess(augment=False, visualize=False, size=config.tile_size),
         )
 
-        global_pred = predict_entire_mask_downscaled(
-            predict_dataset, model, batch_size=config.val_bs, tta=False
-        )
+        with torch.inference_mode(), torch.cuda.amp.autocast(dtype=torch.float16):
+            global_pred = predict_entire_mask_downscaled(
+                predict_dataset, model, batch_size=config.val_bs, tta=False
+            )
 
-        threshold, score = tweak_threshold(
-            mask=torch.from_numpy(predict_dataset.mask).cuda(), pred=global_pred
-        )
+            threshold, score = tweak_threshold(
+                mask=torch.from_numpy(predict_dataset.mask).cuda(), pred=global_pred
+            )
 
         scores.append(score)
         print(
@@ -170,6 +244,9 @@ def k_fold(config, log_folder=None):
 
         print("\n    -> Validating \n")
 
+        # train re-seeds and disables cuDNN benchmarking at every fold
+        enable_inference_backends()
+
         val_images = in_mem_dataset.valid_set
         scores += validate(model, config, val_images)
 
@@ -177,6 +254,7 @@ def k_fold(config, log_folder=None):
             history.to_csv(log_folder + f"history_{i}.csv", index=False)
 
         if log_folder is None or len(config.selected_folds) == 1:
+            wait_save_as_jit()
             return meter
 
         del meter
@@ -184,4 +262,6 @@ def k_fold(config, log_folder=None):
         torch.cuda.empty_cache()
         gc.collect()
 
+    wait_save_as_jit()
+
     print(f"\n\n  ->  Dice CV : {np.mean(scores) :.3f}  +/- {np.std(scores) :.3f}")
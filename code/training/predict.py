@@ -3,6 +3,9 @@ import torch
 import numpy as np
 from torch.utils.data import DataLoader
 
+from params import NUM_WORKERS, NUM_WORKERS_INFERENCE
+from data.dataset import SwappableDataset
+
 FLIPS = [[-1], [-2], [-2, -1]]
 
 
@@ -29,7 +32,7 @@ def threshold_resize(preds, shape, threshold=0.5):
     return preds
 
 
-def threshold_resize_torch(preds, shape, threshold=0.5):
+def threshold_resize_torch(preds, shape, threshold=0.5, to_numpy=True):
     """
     Thresholds and resizes predictions as a tensor.
 
@@ -37,15 +40,17 @@ def threshold_resize_torch(preds, shape, threshold=0.5):
         preds (torch tensor): Predictions.
         shape (tuple [2]): Shape to resize to
         threshold (float, optional): Threshold. Defaults to 0.5.
+        to_numpy (bool, optional): Whether to bring the result to the cpu. Defaults to True.
 
     Returns:
-        np array: Resized predictions.
+        np array or torch tensor: Resized predictions.
     """
     preds = preds.unsqueeze(0).unsqueeze(0)
     preds = torch.nn.functional.interpolate(
         preds, (shape[1], shape[0]), mode='bilinear', align_corners=False
     )
-    return (preds > threshold).cpu().numpy()[0, 0]
+    preds = (preds > threshold)[0, 0]
+    return preds.cpu().numpy() if to_numpy else preds
 
 
 def get_tile_weighting(size, sigma=1, alpha=1, eps=1e-6):
@@ -85,24 +90,166 @@ def get_tile_weighting(size, sigma=1, alpha=1, eps=1e-6):
     return w.astype(np.float16)
 
 
-def predict_entire_mask(dataset, model, batch_size=32, tta=False):
+def forward_tiles(model, img, num_classes=1, batch_size=None):
+    """
+    Runs a model on a batch of tiles, and only keeps the first class.
+    This works with both torch and TorchScript models.
+    Incomplete batches are padded with zeros to batch_size, so that the model always sees
+    the same input shape.
+
+    Args:
+        model (torch model or ScriptModule): Segmentation model.
+        img (torch tensor [BS x 3 x H x W]): Tiles.
+        num_classes (int, optional): Number of classes of the model. Defaults to 1.
+        batch_size (int or None, optional): Batch size to pad to. Defaults to None.
+
+    Returns:
+        torch tensor [BS x H x W] or [BS x 1 x H x W]: Logits.
+    """
+    n = img.size(0)
+    if batch_size is not None and n < batch_size:
+        padding = img.new_zeros((batch_size - n,) + tuple(img.shape[1:]))
+        img = torch.cat([img, padding]).contiguous(memory_format=torch.channels_last)
+
+    pred = model(img)[:n]
+    if num_classes == 2:
+        pred = pred[:, 0]
+    return pred
+
+
+class CudaPrefetcher:
+    """
+    Wraps a DataLoader of tiles to overlap host to device copies with computations.
+    The next batch is copied to the GPU on a side stream while the current one is processed.
+    """
+    def __init__(self, loader, device="cuda"):
+        """
+        Constructor.
+
+        Args:
+            loader (DataLoader): Loader yielding tiles and positions.
+            device (str, optional): Device for torch. Defaults to "cuda".
+        """
+        self.loader = loader
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def copy(self, batch, stream):
+        """
+        Asynchronously copies a batch to the device on a stream.
+
+        Args:
+            batch (tuple or None): Tiles and positions.
+            stream (torch Stream): Stream to copy on.
+
+        Returns:
+            tuple or None: Tiles on the device and positions.
+        """
+        if batch is None:
+            return None
+
+        img, pos = batch
+        with torch.cuda.stream(stream):
+            img = img.pin_memory().to(
+                self.device, memory_format=torch.channels_last, non_blocking=True
+            )
+        return img, pos
+
+    def __iter__(self):
+        stream = torch.cuda.Stream()
+        loader_iter = iter(self.loader)
+
+        batch = self.copy(next(loader_iter, None), stream)
+        while batch is not None:
+            torch.cuda.current_stream().wait_stream(stream)
+            img, pos = batch
+            img.record_stream(torch.cuda.current_stream())
+
+            batch = self.copy(next(loader_iter, None), stream)
+            yield img, pos
+
+
+def get_loader(dataset, batch_size=32, num_workers=NUM_WORKERS):
+    """
+    Gets the DataLoader to run inference with.
+    DataLoaders are used as is, otherwise one is built for the dataset.
+    Built loaders are used for a single image, so they keep few workers to start quickly,
+    use build_swappable_loader for persistent workers.
+
+    Args:
+        dataset (InferenceDataset or DataLoader): Inference dataset, or loader.
+        batch_size (int, optional): Batch size. Defaults to 32.
+        num_workers (int, optional): Number of workers of built loaders. Defaults to 2.
+
+    Returns:
+        DataLoader: Loader.
+        InferenceDataset or SwappableDataset: Dataset of the loader.
+    """
+    if isinstance(dataset, DataLoader):
+        return dataset, dataset.dataset
+
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        pin_memory=True,
+        num_workers=num_workers,
+    )
+    return loader, dataset
+
+
+def build_swappable_loader(batch_size=32, num_workers=NUM_WORKERS_INFERENCE, transforms=None):
+    """
+    Builds a DataLoader over a SwappableDataset, to reuse across images.
+    Images are changed with loader.dataset.swap(...).
+    Workers are started from a forkserver: inference runs cpu work in threads, and forking
+    while another thread holds a lock (imports, tiff decoding) can deadlock the workers.
+
+    Args:
+        batch_size (int, optional): Batch size. Defaults to 32.
+        num_workers (int, optional): Number of persistent workers. Defaults to 8.
+        transforms (albu transforms or None, optional): Transforms of every image.
+            Defaults to None.
+
+    Returns:
+        DataLoader: Loader.
+    """
+    dataset = SwappableDataset(transforms=transforms)
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        sampler=dataset.sampler,
+        pin_memory=True,
+        num_workers=num_workers,
+        persistent_workers=num_workers > 0,
+        prefetch_factor=4 if num_workers > 0 else None,
+        multiprocessing_context="forkserver" if num_workers > 0 else None,
+    )
+
+
+def predict_entire_mask(dataset, model, batch_size=32, tta=False, num_classes=None):
     """
     Performs inference on an image.
 
     Args:
-        dataset (InferenceDataset): Inference dataset.
+        dataset (InferenceDataset or DataLoader): Inference dataset, or loader over it.
         model (torch model): Segmentation model.
         batch_size (int, optional): Batch size. Defaults to 32.
         tta (bool, optional): Whether to apply tta. Defaults to False.
+        num_classes (int or None, optional): Number of classes. Defaults to model.num_classes.
 
     Returns:
         torch tensor [H x W]: Prediction on the image.
     """
-    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, pin_memory=True)
+    if num_classes is None:
+        num_classes = model.num_classes
 
-    weighting = torch.from_numpy(get_tile_weighting(dataset.tile_size))
-    weighting_cuda = weighting.clone().cuda().unsqueeze(0)
-    weighting = weighting.cuda().half()
+    loader, dataset = get_loader(dataset, batch_size=batch_size)
+
+    weighting = torch.from_numpy(get_tile_weighting(dataset.tile_size)).cuda()
+    weighting_cuda = weighting.unsqueeze(0)
 
     global_pred = torch.zeros(
         (dataset.orig_size[0], dataset.orig_size[1]),
@@ -115,21 +262,15 @@ def predict_entire_mask(dataset, model, batch_size=32, tta=False):
 
     model.eval()
     with torch.no_grad():
-        for img, pos in loader:
-            img = img.to("cuda")
+        for img, pos in CudaPrefetcher(loader):
             _, _, h, w = img.shape
 
-            if model.num_classes == 2:
-                pred = model(img)[:, 0].view(-1, 1, h, w).sigmoid().detach()
-            else:
-                pred = model(img).view(-1, 1, h, w).sigmoid().detach()
+            pred = forward_tiles(model, img, num_classes, batch_size)
+            pred = pred.view(-1, 1, h, w).sigmoid().detach()
 
             if tta:
                 for f in FLIPS:
-                    pred_flip = model(torch.flip(img, f))
-                    if model.num_classes == 2:
-                        pred_flip = pred_flip[:, 0]
-
+                    pred_flip = forward_tiles(model, torch.flip(img, f), num_classes, batch_size)
                     pred_flip = torch.flip(pred_flip, f).view(-1, 1, h, w).sigmoid().detach()
                     pred += pred_flip
                 pred = torch.div(pred, len(FLIPS) + 1)
@@ -138,38 +279,40 @@ def predict_entire_mask(dataset, model, batch_size=32, tta=False):
                 pred, (dataset.tile_size, dataset.tile_size), mode='area'
             ).view(-1, dataset.tile_size, dataset.tile_size)
 
-            pred = (pred * weighting_cuda).half()
+            pred = pred.half() * weighting_cuda
 
             for tile_idx, (x0, x1, y0, y1) in enumerate(pos):
                 global_pred[x0: x1, y0: y1] += pred[tile_idx]
                 global_counter[x0: x1, y0: y1] += weighting
 
-    for i in range(len(global_pred)):
-        global_pred[i] = torch.div(global_pred[i], global_counter[i])
+    global_pred.div_(global_counter)
 
     return global_pred
 
 
-def predict_entire_mask_downscaled(dataset, model, batch_size=32, tta=False):
+def predict_entire_mask_downscaled(dataset, model, batch_size=32, tta=False, num_classes=None):
     """
     Performs inference on an image.
     The "downscaled" means that the mask is kept at a reduced resolution.
     The reduced resolution is the reduce_factor parameter of the dataset.
 
     Args:
-        dataset (InferenceDataset): Inference dataset.
+        dataset (InferenceDataset or DataLoader): Inference dataset, or loader over it.
         model (torch model): Segmentation model.
         batch_size (int, optional): Batch size. Defaults to 32.
         tta (bool, optional): Whether to apply tta. Defaults to False.
+        num_classes (int or None, optional): Number of classes. Defaults to model.num_classes.
 
     Returns:
         torch tensor [H/reduce_factor x W/reduce_factor]: Prediction on the image.
     """
-    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, pin_memory=True)
+    if num_classes is None:
+        num_classes = model.num_classes
 
-    weighting = torch.from_numpy(get_tile_weighting(dataset.tile_size))
-    weighting_cuda = weighting.clone().cuda().unsqueeze(0)
-    weighting = weighting.cuda().half()
+    loader, dataset = get_loader(dataset, batch_size=batch_size)
+
+    weighting = torch.from_numpy(get_tile_weighting(dataset.tile_size)).cuda()
+    weighting_cuda = weighting.unsqueeze(0)
 
     global_pred = torch.zeros(
         (dataset.orig_size[0], dataset.orig_size[1]),
@@ -182,37 +325,31 @@ def predict_entire_mask_downscaled(dataset, model, batch_size=32, tta=False):
 
     model.eval()
     with torch.no_grad():
-        for img, pos in loader:
-            img = img.to("cuda")
+        for img, pos in CudaPrefetcher(loader):
             _, _, h, w = img.shape
 
-            if model.num_classes == 2:
-                pred = model(img)[:, 0].view(-1, h, w).sigmoid().detach()
-            else:
-                pred = model(img).view(-1, h, w).sigmoid().detach()
+            pred = forward_tiles(model, img, num_classes, batch_size)
+            pred = pred.view(-1, h, w).sigmoid().detach()
 
             if tta:
                 for f in FLIPS:
-                    pred_flip = model(torch.flip(img, f))
-                    if model.num_classes == 2:
-                        pred_flip = pred_flip[:, 0]
+                    pred_flip = forward_tiles(model, torch.flip(img, f), num_classes, batch_size)
                     pred_flip = torch.flip(pred_flip, f).view(-1, h, w).sigmoid().detach()
                     pred += pred_flip
                 pred = torch.div(pred, len(FLIPS) + 1)
 
-            pred = (pred * weighting_cuda).half()
+            pred = pred.half() * weighting_cuda
 
             for tile_idx, (x0, x1, y0, y1) in enumerate(pos):
                 global_pred[x0: x1, y0: y1] += pred[tile_idx]
                 global_counter[x0: x1, y0: y1] += weighting
 
-    for i in range(len(global_pred)):
-        global_pred[i] = torch.div(global_pred[i], global_counter[i])
+    global_pred.div_(global_counter)
 
     return global_pred
 
 
-def predict_entire_mask_downscaled_tta(dataset, model, batch_size=32):
+def predict_entire_mask_downscaled_tta(dataset, model, batch_size=32, num_classes=None):
     """
     Performs inference on an image.
     The "downscaled" means that the mask is kept at a reduced resolution.
@@ -220,19 +357,22 @@ def predict_entire_mask_downscaled_tta(dataset, model, batch_size=32):
     The "tta" means that it returns predictions for each tta.
 
     Args:
-        dataset (InferenceDataset): Inference dataset.
+        dataset (InferenceDataset or DataLoader): Inference dataset, or loader over it.
         model (torch model): Segmentation model.
         batch_size (int, optional): Batch size. Defaults to 32.
+        num_classes (int or None, optional): Number of classes. Defaults to model.num_classes.
 
     Returns:
         torch tensor [4 x H/reduce_factor x W/reduce_factor]: Prediction on the image.
     """
 
-    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, pin_memory=True)
+    if num_classes is None:
+        num_classes = model.num_classes
+
+    loader, dataset = get_loader(dataset, batch_size=batch_size)
 
-    weighting = torch.from_numpy(get_tile_weighting(dataset.tile_size))
-    weighting_cuda = weighting.clone().cuda().unsqueeze(0).unsqueeze(0)
-    weighting = weighting.cuda().half()
+    weighting = torch.from_numpy(get_tile_weighting(dataset.tile_size)).cuda()
+    weighting_cuda = weighting.unsqueeze(0).unsqueeze(0)
 
     global_pred = torch.zeros(
         (4, dataset.orig_size[0], dataset.orig_size[1]),
@@ -245,32 +385,26 @@ def predict_entire_mask_downscaled_tta(dataset, model, batch_size=32):
 
     model.eval()
     with torch.no_grad():
-        for img, pos in loader:
-            img = img.to("cuda")
+        for img, pos in CudaPrefetcher(loader):
             _, _, h, w = img.shape
 
             preds = []
-            if model.num_classes == 2:
-                pred = model(img)[:, 0].view(1, -1, h, w).sigmoid().detach()
-            else:
-                pred = model(img).view(1, -1, h, w).sigmoid().detach()
+            pred = forward_tiles(model, img, num_classes, batch_size)
+            pred = pred.view(1, -1, h, w).sigmoid().detach()
             preds.append(pred)
 
             for f in FLIPS:
-                pred_flip = model(torch.flip(img, f))
-                if model.num_classes == 2:
-                    pred_flip = pred_flip[:, 0]
+                pred_flip = forward_tiles(model, torch.flip(img, f), num_classes, batch_size)
                 pred_flip = torch.flip(pred_flip, f).view(1, -1, h, w).sigmoid().detach()
                 preds.append(pred_flip)
 
             pred = torch.cat(preds, 0)
-            pred = (pred * weighting_cuda).half()
+            pred = pred.half() * weighting_cuda
 
             for tile_idx, (x0, x1, y0, y1) in enumerate(pos):
                 global_pred[:, x0: x1, y0: y1] += pred[:, tile_idx]
                 global_counter[:, x0: x1, y0: y1] += weighting
 
-    for i in range(global_pred.size(1)):
-        global_pred[:, i] = torch.div(global_pred[:, i], global_counter[:, i])
+    global_pred.div_(global_counter)
 
     return global_pred
@@ -29,6 +29,8 @@ def fit(
     verbose=1,
     first_epoch_eval=0,
     num_classes=1,
+    ema_decay=0,
+    ema_first_epoch=0,
     device="cuda",
 ):
     """
@@ -50,6 +52,9 @@ def fit(
         verbose (int, optional): Period (in epochs) to display logs at. Defaults to 1.
         first_epoch_eval (int, optional): Epoch to start evaluating at. Defaults to 0.
         num_classes (int, optional): Number of classes. Defaults to 1.
+        ema_decay (float, optional): Decay of the exponential moving average of the weights,
+            which are used at the end of the training. 0 to disable. Defaults to 0.
+        ema_first_epoch (int, optional): Epoch to start averaging the weights at. Defaults to 0.
         device (str, optional): Device for torch. Defaults to "cuda".
 
     Returns:
@@ -84,6 +89,9 @@ def fit(
         optimizer, num_warmup_steps, num_training_steps
     )
 
+    params = [p for p in model.parameters() if p.requires_grad]
+    ema = None
+
     for epoch in range(epochs):
         model.train()
         dataset.train(True)
@@ -131,6 +139,14 @@ def fit(
             for param in model.parameters():
                 param.grad = None
 
+            if ema_decay > 0 and epoch >= ema_first_epoch:
+                with torch.no_grad():
+                    if ema is None:
+                        ema = [p.detach().clone() for p in params]
+                    else:
+                        torch._foreach_mul_(ema, ema_decay)
+                        torch._foreach_add_(ema, params, alpha=1 - ema_decay)
+
         model.eval()
         dataset.train(False)
         avg_val_loss = 0.
@@ -186,6 +202,15 @@ def fit(
                 history, metrics, epoch + 1, avg_loss, avg_val_loss, elapsed_time
             )
 
+    if ema is not None:
+        with torch.no_grad():
+            if hasattr(torch, "_foreach_copy_"):
+                torch._foreach_copy_(params, ema)
+            else:
+                for p, p_ema in zip(params, ema):
+                    p.copy_(p_ema)
+        del ema
+
     del (data_loader, y_pred, loss, x, y_batch)
     torch.cuda.empty_cache()
 
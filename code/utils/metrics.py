@@ -1,3 +1,4 @@
+import torch
 import numpy as np
 
 
@@ -85,24 +86,36 @@ def dice_score_tensor(pred, truth, eps=1e-8, threshold=0.5):
     return dice.mean()
 
 
-def tweak_threshold(mask, pred):
+def tweak_threshold(mask, pred, eps=1e-8):
     """
     Tweaks the threshold to maximise the score.
+    Scores for every threshold are computed at once : pixels are binned by threshold,
+    and the number of positives above each threshold are obtained with cumulative sums.
 
     Args:
         mask (torch tensor): Ground truths.
         pred (torch tensor): Predictions.
+        eps (float, optional): epsilon to avoid dividing by 0. Defaults to 1e-8.
 
     Returns:
         float: Best threshold.
         float: Best score.
     """
-    thresholds = []
-    scores = []
-    for threshold in np.linspace(0.2, 0.7, 11):
+    thresholds = np.linspace(0.2, 0.7, 11)
+    boundaries = torch.tensor(thresholds, dtype=pred.dtype, device=pred.device)
+
+    # bins[i] > k if and only if pred[i] > thresholds[k]
+    bins = torch.bucketize(pred.reshape(-1), boundaries, out_int32=True)
+    truth = mask.reshape(-1) > 0
+
+    counts = torch.bincount(bins, minlength=len(thresholds) + 1)
+    counts_truth = torch.bincount(bins[truth], minlength=len(thresholds) + 1)
 
-        dice_score = dice_scores_img_tensor(pred=pred > threshold, truth=mask)
-        thresholds.append(threshold)
-        scores.append(dice_score)
+    positives = counts.flip(0).cumsum(0).flip(0)[1:]
+    intersect = counts_truth.flip(0).cumsum(0).flip(0)[1:]
+    union = positives + truth.sum()
+
+    dice = (2.0 * intersect + eps) / (union + eps)
+    best = int(dice.argmax())
 
-    return thresholds[np.argmax(scores)], np.max(scores)
+    return thresholds[best], float(dice[best])
@@ -1,4 +1,22 @@
 import numpy as np
+import pandas as pd
+from numba import njit
+
+
+# compiled eagerly at import, in the main thread, as callers decode masks from worker threads
+@njit("void(int64[:], int64[:], uint8[:], int64)", cache=True)
+def _enc2mask_nb(starts, lengths, out, value):
+    """
+    Fills the runs of a rle in a flat mask.
+
+    Args:
+        starts (np int64 array): Starting indices of the runs (0-indexed).
+        lengths (np int64 array): Lengths of the runs.
+        out (np uint8 array): Flat mask to fill.
+        value (int): Value to fill the runs with.
+    """
+    for i in range(len(starts)):
+        out[starts[i]: starts[i] + lengths[i]] = value
 
 
 def enc2mask(encs, shape):
@@ -14,16 +32,52 @@ def enc2mask(encs, shape):
     """
     img = np.zeros(shape[0] * shape[1], dtype=np.uint8)
     for m, enc in enumerate(encs):
-        if isinstance(enc, np.float) and np.isnan(enc):
+        if isinstance(enc, float) and np.isnan(enc):
             continue
-        enc_split = enc.split()
-        for i in range(len(enc_split) // 2):
-            start = int(enc_split[2 * i]) - 1
-            length = int(enc_split[2 * i + 1])
-            img[start: start + length] = 1 + m
+        runs = np.fromstring(enc, dtype=np.int64, sep=" ")
+        _enc2mask_nb(runs[0::2] - 1, runs[1::2], img, 1 + m)
+    return img.reshape(shape).T
+
+
+def runs2mask(starts, lengths, shape):
+    """
+    Decodes a rle already parsed as runs.
+
+    Args:
+        starts (np int64 array): Starting indices of the runs (0-indexed).
+        lengths (np int64 array): Lengths of the runs.
+        shape (tuple [2]): Mask size.
+
+    Returns:
+        np array [shape]: Mask.
+    """
+    img = np.zeros(shape[0] * shape[1], dtype=np.uint8)
+    _enc2mask_nb(starts, lengths, img, 1)
     return img.reshape(shape).T
 
 
+def precompute_rle_cache(csv_path, cache_path):
+    """
+    Parses the rles of a csv once, and saves the runs of each image to a .npz file.
+    The runs of image id are stored under the keys "{id}_starts" (0-indexed) and "{id}_lengths".
+
+    Args:
+        csv_path (str): Path to the csv with id and encoding columns.
+        cache_path (str): Path to save the .npz file to.
+    """
+    df = pd.read_csv(csv_path)
+
+    runs = {}
+    for img, enc in zip(df["id"], df["encoding"]):
+        if isinstance(enc, float) and np.isnan(enc):
+            enc = ""
+        tokens = np.fromstring(enc, dtype=np.int64, sep=" ")
+        runs[f"{img}_starts"] = tokens[0::2] - 1
+        runs[f"{img}_lengths"] = tokens[1::2]
+
+    np.savez(cache_path, **runs)
+
+
 def mask2enc(mask, n=1):
     """
     Encodes a mask to rle
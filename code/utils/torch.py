@@ -18,6 +18,37 @@ def seed_everything(seed):
     torch.cuda.manual_seed(seed)
     torch.backends.cudnn.deterministic = True
     torch.backends.cudnn.benchmark = False
+    # undo enable_inference_backends, every fold trains with the default precisions
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cuda.matmul.allow_tf32 = False
+    torch.set_float32_matmul_precision("highest")
+
+
+def enable_inference_backends():
+    """
+    Lets cuDNN benchmark convolution algorithms and enables TF32 kernels.
+    Inference is done on tiles of fixed size, so the selected algorithms are always reused.
+    """
+    torch.backends.cudnn.deterministic = False
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.set_float32_matmul_precision("high")
+
+
+def enable_expandable_segments():
+    """
+    Makes the CUDA caching allocator grow its segments instead of allocating new blocks,
+    which avoids the fragmentation caused by full resolution predictions of different sizes.
+    Requires PyTorch >= 2.1, does nothing otherwise.
+    """
+    if not hasattr(torch.cuda.memory, "_set_allocator_settings"):
+        return
+
+    try:
+        torch.cuda.memory._set_allocator_settings("expandable_segments:True")
+    except RuntimeError:
+        pass
 
 
 def save_model_weights(model, filename, verbose=1, cp_folder=""):
@@ -88,3 +119,151 @@ def worker_init_fn(worker_id):
         worker_id (int]): Id of the worker.
     """
     np.random.seed(np.random.get_state()[1][0] + worker_id)
+
+
+def compile_model(model, mode="reduce-overhead"):
+    """
+    Compiles a model with torch.compile. Falls back to eager mode for PyTorch < 2.0.
+
+    Args:
+        model (torch model): Model to compile.
+        mode (str, optional): Compilation mode. Defaults to "reduce-overhead".
+
+    Returns:
+        torch model: Compiled model, or the input model if compilation is not available.
+    """
+    try:
+        return torch.compile(model, mode=mode, fullgraph=False)
+    except (AttributeError, RuntimeError):
+        return model
+
+
+def warmup_model(model, input_shape, device="cuda", memory_format=torch.contiguous_format):
+    """
+    Runs a batch of zeros through a model, in eval mode.
+    This pays the compilation and algorithm selection costs before the actual inference.
+
+    Args:
+        model (torch model): Model to warm up.
+        input_shape (tuple [4]): Shape of the input batch.
+        device (str, optional): Device for torch. Defaults to "cuda".
+        memory_format (torch memory_format, optional): Input layout. Defaults to contiguous.
+    """
+    model.eval()
+    with torch.no_grad():
+        model(torch.zeros(input_shape, device=device).contiguous(memory_format=memory_format))
+
+
+class CudaGraphModel:
+    """
+    Captures the fp16 forward of a model on a fixed input shape in a CUDA graph,
+    and replays the graph instead of launching the kernels one by one.
+    Inputs of another shape fall back to the wrapped model, incomplete batches should be padded.
+    Replays share the same static buffers, so the ones issued on different streams are serialized.
+    """
+    def __init__(self, model, input_shape, device="cuda", warmup_iters=3):
+        """
+        Constructor.
+
+        Args:
+            model (torch model or ScriptModule): Model in eval mode, in channels_last.
+            input_shape (tuple [4]): Shape of the input batch.
+            device (str, optional): Device for torch. Defaults to "cuda".
+            warmup_iters (int, optional): Number of forwards to run before capture. Defaults to 3.
+        """
+        self.model = model
+        self.num_classes = getattr(model, "num_classes", 1)
+        self.static_in = torch.zeros(input_shape, device=device).contiguous(
+            memory_format=torch.channels_last
+        )
+
+        # the autocast weight cache is freed on exit, the graph must own its fp16 casts
+        autocast = torch.autocast("cuda", dtype=torch.float16, cache_enabled=False)
+        with torch.inference_mode(), autocast:
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(warmup_iters):
+                    model(self.static_in)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            self.graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self.graph):
+                self.static_out = model(self.static_in)
+
+        self.done = None
+
+    def eval(self):
+        return self
+
+    def __call__(self, x):
+        """
+        Replays the graph on a batch.
+
+        Args:
+            x (torch tensor [BS x 3 x H x W]): Input batch, on the GPU.
+
+        Returns:
+            torch tensor [BS x num_classes x H x W]: Logits.
+        """
+        if x.shape != self.static_in.shape:
+            return self.model(x)
+
+        stream = torch.cuda.current_stream()
+        if self.done is not None:
+            stream.wait_event(self.done)
+
+        self.static_in.copy_(x)
+        self.graph.replay()
+        y = self.static_out.clone()
+
+        self.done = torch.cuda.Event()
+        self.done.record(stream)
+        return y
+
+
+def save_as_jit(model, filename, tile_size=256, verbose=1, cp_folder=""):
+    """
+    Traces a PyTorch model and saves it as TorchScript.
+    Models using the memory efficient swish of EfficientNets cannot be traced.
+
+    Args:
+        model (torch model): Model to trace.
+        filename (str): Name of the traced model.
+        tile_size (int, optional): Size of the tiles fed to the model. Defaults to 256.
+        verbose (int, optional): Whether to display infos. Defaults to 1.
+        cp_folder (str, optional): Folder to save to. Defaults to "".
+
+    Returns:
+        torch ScriptModule: Traced model.
+    """
+    if verbose:
+        print(f"\n -> Saving traced model to {os.path.join(cp_folder, filename)}\n")
+
+    device = next(model.parameters()).device
+    model.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(model, torch.zeros((1, 3, tile_size, tile_size), device=device))
+
+    torch.jit.save(traced, os.path.join(cp_folder, filename))
+    return traced
+
+
+def load_jit_model(filename, device="cuda", verbose=1, cp_folder=""):
+    """
+    Loads a TorchScript model and freezes it for inference.
+
+    Args:
+        filename (str): Name of the traced model.
+        device (str, optional): Device for torch. Defaults to "cuda".
+        verbose (int, optional): Whether to display infos. Defaults to 1.
+        cp_folder (str, optional): Folder to load from. Defaults to "".
+
+    Returns:
+        torch ScriptModule: Frozen model.
+    """
+    if verbose:
+        print(f"\n -> Loading traced model from {os.path.join(cp_folder, filename)}\n")
+
+    model = torch.jit.load(os.path.join(cp_folder, filename), map_location=device).eval()
+    return torch.jit.optimize_for_inference(model)
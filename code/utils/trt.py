@@ -0,0 +1,152 @@
+import torch
+import inspect
+import tensorrt as trt
+
+TRT_LOGGER = trt.Logger(trt.Logger.WARNING)
+
+TRT_DTYPES = {
+    trt.float32: torch.float32,
+    trt.float16: torch.float16,
+}
+
+
+def export_onnx(model, onnx_path, tile_size=256, device="cuda"):
+    """
+    Exports a model to ONNX, with a dynamic batch size.
+    The memory efficient swish of EfficientNet encoders is not exportable and is disabled.
+
+    Args:
+        model (torch model): Model to export.
+        onnx_path (str): Path to save the ONNX model to.
+        tile_size (int, optional): Size of the tiles fed to the model. Defaults to 256.
+        device (str, optional): Device for torch. Defaults to "cuda".
+    """
+    if hasattr(model.encoder, "set_swish"):
+        model.encoder.set_swish(memory_efficient=False)
+
+    model.eval()
+
+    # recent torch versions default to the dynamo exporter, which ignores dynamic_axes
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False
+
+    torch.onnx.export(
+        model,
+        torch.randn((1, 3, tile_size, tile_size), device=device),
+        onnx_path,
+        input_names=["x"],
+        output_names=["y"],
+        opset_version=17,
+        dynamic_axes={"x": {0: "B"}, "y": {0: "B"}},
+        **kwargs,
+    )
+
+
+def build_engine(
+    onnx_path, engine_path, tile_size=256, batch_size=32, fp16=True, workspace=4 << 30
+):
+    """
+    Builds a TensorRT engine from an ONNX model, and serializes it.
+    The engine is optimized for batches of batch_size tiles.
+
+    Args:
+        onnx_path (str): Path to the ONNX model.
+        engine_path (str): Path to save the engine to.
+        tile_size (int, optional): Size of the tiles fed to the model. Defaults to 256.
+        batch_size (int, optional): Maximum batch size. Defaults to 32.
+        fp16 (bool, optional): Whether to allow fp16 kernels. Defaults to True.
+        workspace (int, optional): Workspace size in bytes. Defaults to 4GB.
+    """
+    builder = trt.Builder(TRT_LOGGER)
+    network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, TRT_LOGGER)
+
+    with open(onnx_path, "rb") as f:
+        if not parser.parse(f.read()):
+            errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+            raise RuntimeError("Failed to parse ONNX model :\n" + "\n".join(errors))
+
+    config = builder.create_builder_config()
+    config.set_memory_pool_limit(trt.MemoryPoolType.WORKSPACE, workspace)
+    if fp16:
+        config.set_flag(trt.BuilderFlag.FP16)
+
+    profile = builder.create_optimization_profile()
+    profile.set_shape(
+        "x",
+        (1, 3, tile_size, tile_size),
+        (batch_size, 3, tile_size, tile_size),
+        (batch_size, 3, tile_size, tile_size),
+    )
+    config.add_optimization_profile(profile)
+
+    engine = builder.build_serialized_network(network, config)
+    if engine is None:
+        raise RuntimeError(f"Failed to build TensorRT engine from {onnx_path}")
+
+    with open(engine_path, "wb") as f:
+        f.write(engine)
+
+
+class TrtModel:
+    """
+    Runs a serialized TensorRT engine on the current CUDA stream, like a torch model.
+    Executions share the same context, so the ones issued on different streams are serialized.
+    """
+    def __init__(self, engine_path):
+        """
+        Constructor.
+
+        Args:
+            engine_path (str): Path to the serialized engine.
+        """
+        runtime = trt.Runtime(TRT_LOGGER)
+        with open(engine_path, "rb") as f:
+            self.engine = runtime.deserialize_cuda_engine(f.read())
+        self.context = self.engine.create_execution_context()
+
+        names = [self.engine.get_tensor_name(i) for i in range(self.engine.num_io_tensors)]
+        self.input_name = [
+            n for n in names if self.engine.get_tensor_mode(n) == trt.TensorIOMode.INPUT
+        ][0]
+        self.output_name = [
+            n for n in names if self.engine.get_tensor_mode(n) == trt.TensorIOMode.OUTPUT
+        ][0]
+        self.output_dtype = TRT_DTYPES[self.engine.get_tensor_dtype(self.output_name)]
+
+        self.done = None
+
+    def eval(self):
+        return self
+
+    def __call__(self, x):
+        """
+        Runs the engine on a batch.
+
+        Args:
+            x (torch tensor [BS x 3 x H x W]): Input batch, on the GPU.
+
+        Returns:
+            torch tensor [BS x num_classes x H x W]: Logits.
+        """
+        x = x.float().contiguous()
+        self.context.set_input_shape(self.input_name, tuple(x.shape))
+
+        y = torch.empty(
+            tuple(self.context.get_tensor_shape(self.output_name)),
+            dtype=self.output_dtype,
+            device=x.device,
+        )
+
+        stream = torch.cuda.current_stream()
+        if self.done is not None:
+            stream.wait_event(self.done)
+
+        self.context.set_tensor_address(self.input_name, x.data_ptr())
+        self.context.set_tensor_address(self.output_name, y.data_ptr())
+        self.context.execute_async_v3(stream.cuda_stream)
+
+        self.done = torch.cuda.Event()
+        self.done.record(stream)
+        return y